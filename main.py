@@ -1,247 +1,530 @@
 import boto3
+from botocore.config import Config
 import collections
+import concurrent.futures
+import logging
 import os                             
+import math
+import threading
+import time
 import gspread           #Interact with Google sheets
-import gspread.utils     #Helper to convert cell coordinates
 import json              #Used to parse Google credentials (service key)
-from gspread_formatting import *  #Apply colors, borders and formatting to the gsheet
 from google.oauth2.service_account import Credentials   #Authenticate to gcp using service account
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain, groupby
+try:
+    import orjson        #Faster JSON decoding of the Google key (optional, from the layer)
+except ImportError:
+    orjson = None
+try:
+    from aws_xray_sdk.core import xray_recorder     #Subsegments around external calls (optional, from the layer)
+except ImportError:
+    xray_recorder = None
+# Only Lambda provides the segment that subsegments attach to; elsewhere every call would log a missing-segment error
+if 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ:
+    xray_recorder = None
+
+# Lambda already attaches a handler to the root logger; basicConfig only adds one when run elsewhere
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 # --- Configuration ---
 REPORTING_PERIOD_DAYS = 30
 CPU_THRESHOLD = 20
 CPU_CREDIT_THRESHOLD = 100
-IGNORE_SIZES = ['small', 'micro', 'nano']           #Consider size medium or higher
+METRIC_PERIOD = REPORTING_PERIOD_DAYS * 86400       #One datapoint covering the whole reporting period
+MIN_HISTORY_DAYS = REPORTING_PERIOD_DAYS // 2       #Instances with fewer days of CPU data aren't recommended for downsizing
+COVERAGE_PERIOD = 86400                             #Daily buckets, counted to find the days an instance reported CPU data
+IGNORE_SIZES = frozenset({'small', 'micro', 'nano'}) #Consider size medium or higher
+BURSTABLE_FAMILIES = frozenset({'t1', 't2', 't3', 't3a', 't4g'})  #Families with CPU credits (not trn*, which also start with 't')
+# DescribeInstances can't exclude sizes, so this allow-list covers everything IGNORE_SIZES keeps:
+# medium, large, every *xlarge (incl. 9xlarge, 48xlarge...) and metal / metal-24xl
+REPORT_SIZE_PATTERNS = ['*.medium', '*.large', '*xlarge', '*.metal*']
+MAX_METRIC_QUERIES = 500                            #GetMetricData limit on queries per call
+DESCRIBE_WORKERS = 32                               #Regions described in parallel (all of them in one wave)
+METRICS_WORKERS = 10                                #Regions queried in parallel on CloudWatch (throttling)
+BATCH_WORKERS = 4                                   #GetMetricData batches in flight per region
+INSTANCE_TYPES_TTL = 24 * 3600                      #Seconds a region's DescribeInstanceTypes catalog is reused
+REGIONS_TTL = 24 * 3600                             #Seconds the DescribeRegions list is reused
+
+# Column order of the report rows, which are plain tuples
+REPORT_HEADERS = ('InstanceId', 'Region', 'InstanceType', 'Name', 'Avg.CPU%', 'Avg.CPUCredits', 'Recommendation')
 
 # --- Environment Variables (Will be set by Terraform) ---
 SHEET_KEY = os.environ['GOOGLE_SHEET_KEY'] 
 SECRET_ARN = os.environ['GOOGLE_SECRET_ARN'] 
+# Optional comma-separated region list (e.g. "us-east-1,eu-west-1"); skips DescribeRegions entirely
+AWS_REGIONS = [region.strip() for region in os.environ.get('AWS_REGIONS', '').split(',') if region.strip()]
+
+# Adaptive retries back off client-side when CloudWatch/EC2 throttle the parallel
+# region workers; the larger pool keeps concurrent calls from queueing on urllib3
+CLIENT_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=64, tcp_keepalive=True)
+
+# One explicit session shared by every cached client, so credentials and service
+# models are resolved once instead of per client
+SESSION = boto3.session.Session()
+
+# Clients are built on first use (see _client) rather than at import
+_client_lock = threading.Lock()
+_instance_types_cache = {}      # region -> (fetched_at, catalog), survives warm Lambda invocations
+_regions_cache = (0.0, None)    # (fetched_at, region names), survives warm invocations
+_gspread_client = None          # Set by get_gspread_client, also survives warm invocations
 
-# Initialize Clients
-ec2_client = boto3.client('ec2')
-secrets_client = boto3.client('secretsmanager')
+@lru_cache(maxsize=None)
+def _client(service, region):
+    # Clients are thread-safe once built, but building them from a shared
+    # session is not, so construction is serialized
+    with _client_lock:
+        return SESSION.client(service, region_name=region, config=CLIENT_CONFIG)
+
+# On Lambda, build the default-region clients during container init so warm and
+# cold invocations alike start with them ready; elsewhere they stay lazy
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    _client('ec2', None)
+    _client('secretsmanager', None)
+
+@contextmanager
+def _traced(name, **fields):
+    """Times an external call: one JSON timing log line, plus an X-Ray subsegment on Lambda when the SDK is present."""
+    start = time.perf_counter()
+    with xray_recorder.in_subsegment(name) if xray_recorder is not None else nullcontext() as subsegment:
+        if subsegment is not None:
+            for key, value in fields.items():
+                subsegment.put_annotation(key, value)
+        try:
+            yield
+        finally:
+            fields.update(span=name, duration_ms=round((time.perf_counter() - start) * 1000, 1))
+            logger.info(json.dumps(fields))
 
 # --- Google Sheets Functions ---
 def authenticate_gspread():
-    print("Authenticating with Google...")
-    secret_response = secrets_client.get_secret_value(SecretId=SECRET_ARN)
-    creds_json = json.loads(secret_response['SecretString'])
+    logger.info("Authenticating with Google...")
+    with _traced('secretsmanager.get_secret_value'):
+        secret_response = _client('secretsmanager', None).get_secret_value(SecretId=SECRET_ARN)
+    secret_string = secret_response['SecretString']
+    creds_json = orjson.loads(secret_string) if orjson is not None else json.loads(secret_string)
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive'
     ]
     creds = Credentials.from_service_account_info(creds_json, scopes=scopes)
     gc = gspread.authorize(creds)
-    print("Google authentication successful.")
+    logger.info("Google authentication successful.")
     return gc
 
-def write_to_sheet(gc, report_data):
-    """Writes the report data to a new, dated sheet and formats it as a table."""
-    try:
-        sh = gc.open_by_key(SHEET_KEY)
-        
-        sheet_name = datetime.now(timezone.utc).strftime("%m/%d/%y")
-        
-        print(f"Creating new worksheet named: {sheet_name}")
-        worksheet = sh.add_worksheet(title=sheet_name, rows=1, cols=1)
-        
-        if not report_data:
-            worksheet.update('A1', [["No underutilized instances found."]]) 
-            print("No underutilized instances found.")
-            return
-
-        # Prepare data for upload
-        headers = list(report_data[0].keys())
-        values = [list(d.values()) for d in report_data]
-        full_data_list = [headers] + values
-        
-        num_rows = len(full_data_list)
-        num_cols = len(headers)
-        
-        worksheet.resize(rows=num_rows, cols=num_cols)
-        worksheet.update('A1', full_data_list, value_input_option='USER_ENTERED')
-        print(f"Successfully wrote {len(report_data)} rows to sheet '{sheet_name}'.")
+def get_gspread_client():
+    """Returns the authenticated gspread client, authenticating only once per Lambda container."""
+    # google-auth refreshes the token when it nears expiry, so the client stays valid across warm invocations
+    global _gspread_client
+    if _gspread_client is None:
+        _gspread_client = authenticate_gspread()
+    return _gspread_client
 
-        # --- FORMATTING SECTION ---
-        print("Applying table formatting...")
+def write_to_sheet(gc, report_rows):
+    """Writes the report rows to a new, dated sheet, formats it as a table and returns the row count."""
+    today = datetime.now(timezone.utc)
+    sheet_name = today.strftime("%m/%d/%y")
+    # Chosen up front so the formatting can target the sheet in the same batchUpdate that creates it;
+    # one sheet per day, so the date is as unique as the title
+    sheet_id = int(today.strftime("%Y%m%d"))
 
-        # 1. Define Formats
-        HEADER_BACKGROUND_COLOR = Color(0.9, 0.9, 0.9) # Light gray
-        ALT_ROW_COLOR = Color(0.95, 0.95, 0.95)         # Lighter gray
-        
-        header_format = CellFormat(
-            backgroundColor=HEADER_BACKGROUND_COLOR,
-            textFormat=TextFormat(bold=True),
-            horizontalAlignment='CENTER'
-        )
-        
-        border = Border("SOLID", Color(0, 0, 0)) # Black, solid border
-        all_cells_base_format = CellFormat(borders=Borders(top=border, bottom=border, left=border, right=border))
+    try:
+        # Opened before the rows are consumed, so it overlaps the metric fetches still running
+        with _traced('sheets.open_by_key'):
+            sh = gc.open_by_key(SHEET_KEY)
+    except Exception as e:
+        logger.error("An error occurred opening the spreadsheet: %s", e)
+        raise
+
+    # Consumed outside the Sheets error handling: a failure here comes from AWS or the analysis
+    try:
+        # Peek at the first row to detect an empty report, then consume the rest as they arrive
+        report_rows = iter(report_rows)
+        first_row = next(report_rows, None)
+        if first_row is None:
+            full_data_list = [["No underutilized instances found."]]
+        else:
+            # Prepare data for upload, formatting the raw metrics in a single pass.
+            # Appended in place rather than concatenating a second copy of the rows.
+            full_data_list = [list(REPORT_HEADERS)]
+            full_data_list.extend(
+                [inst_id, region, inst_type, name, "N/A" if math.isnan(cpu_avg) else f"{cpu_avg:.2f}",
+                 "N/A" if math.isnan(cpu_credit_avg) else f"{cpu_credit_avg:.0f}", rec]
+                for inst_id, region, inst_type, name, cpu_avg, cpu_credit_avg, rec in chain([first_row], report_rows)
+            )
+    except Exception as e:
+        logger.error("An error occurred building the report rows: %s", e)
+        raise
 
-        # 2. Apply Header and Border Formats
-        end_cell = gspread.utils.rowcol_to_a1(num_rows, num_cols)
-        header_end_cell = gspread.utils.rowcol_to_a1(1, num_cols)
-        data_range = f"A1:{end_cell}"
+    try:
+        num_rows = len(full_data_list)
+        num_cols = len(full_data_list[0])
         
-        format_cell_range(worksheet, f"A1:{header_end_cell}", header_format)
+        # Created at its final size, so no separate resize call is needed before the write
+        logger.info("Creating new worksheet named: %s", sheet_name)
+        requests = [{'addSheet': {'properties': {
+            'sheetId': sheet_id, 'title': sheet_name,
+            'gridProperties': {'rowCount': num_rows, 'columnCount': num_cols}
+        }}}]
 
-        format_cell_range(worksheet, data_range, all_cells_base_format)
+        if first_row is not None:
+            requests.extend(table_format_requests(sheet_id, num_rows, num_cols))
 
-        # 3. Apply Alternating Row Colors
-        for i in range(2, num_rows + 1): # Start from row 2 (data)
-            if i % 2 == 0: # Even-numbered rows
-                row_range = f"A{i}:{gspread.utils.rowcol_to_a1(i, num_cols)}"
-                format_cell_range(worksheet, row_range, CellFormat(backgroundColor=ALT_ROW_COLOR))
+        # Sheet creation and all formatting go in one spreadsheets.batchUpdate call, the values in one more
+        with _traced('sheets.batch_update', requests=len(requests)):
+            sh.batch_update({'requests': requests})
+        with _traced('sheets.values_update', rows=num_rows):
+            sh.values_update(f"'{sheet_name}'!A1", params={'valueInputOption': 'USER_ENTERED'},
+                             body={'values': full_data_list})
 
-        # 4. Set Column Widths (Example widths, adjust as needed)
-        set_column_widths(worksheet, [
-            ('A', 150), # InstanceId
-            ('B', 200), # InstanceName
-            ('C', 120), # Region
-            ('D', 120), # InstanceType
-            ('E', 80),  # AvgCPU
-            ('F', 100), # AvgCPUCredits
-            ('G', 200)  # Recommendation
-        ])
+        if first_row is None:
+            logger.info("No underutilized instances found.")
+            return 0
 
-        print("Applied all formatting.")
+        logger.info("Successfully wrote %d rows to sheet '%s' and applied all formatting.", num_rows - 1, sheet_name)
+        return num_rows - 1
 
     except gspread.exceptions.APIError as e:
         if "already exists" in str(e):
-            print(f"Sheet '{sheet_name}' already exists. Skipping.")
+            logger.info("Sheet '%s' already exists. Skipping.", sheet_name)
+            return 0
         else:
-            print(f"A gspread API error occurred: {e}")
+            logger.error("A gspread API error occurred: %s", e)
             raise
     except Exception as e:
-        print(f"An error occurred writing to the sheet: {e}")
+        logger.error("An error occurred writing to the sheet: %s", e)
         raise
 
+# --- FORMATTING SECTION ---
+def table_format_requests(sheet_id, num_rows, num_cols):
+    """Returns the batchUpdate requests that format a report sheet as a table."""
+    # 1. Define Formats
+    HEADER_BACKGROUND_COLOR = {'red': 0.9, 'green': 0.9, 'blue': 0.9}      # Light gray
+    ALT_ROW_COLOR = {'red': 0.95, 'green': 0.95, 'blue': 0.95}             # Lighter gray
+    WHITE = {'red': 1, 'green': 1, 'blue': 1}
+    border = {'style': 'SOLID', 'color': {'red': 0, 'green': 0, 'blue': 0}}  # Black, solid border
+
+    def grid_range(start_row, end_row):
+        return {'sheetId': sheet_id, 'startRowIndex': start_row, 'endRowIndex': end_row,
+                'startColumnIndex': 0, 'endColumnIndex': num_cols}
+
+    requests = [
+        # 2. Header and Border Formats
+        {'repeatCell': {
+            'range': grid_range(0, 1),
+            'cell': {'userEnteredFormat': {
+                'backgroundColor': HEADER_BACKGROUND_COLOR,
+                'textFormat': {'bold': True},
+                'horizontalAlignment': 'CENTER'
+            }},
+            'fields': 'userEnteredFormat(backgroundColor,textFormat.bold,horizontalAlignment)'
+        }},
+        {'updateBorders': {
+            'range': grid_range(0, num_rows),
+            'top': border, 'bottom': border, 'left': border, 'right': border,
+            'innerHorizontal': border, 'innerVertical': border
+        }},
+        # 3. Alternating Row Colors, starting from row 2 (data); the server handles the alternation
+        {'addBanding': {'bandedRange': {
+            'range': grid_range(1, num_rows),
+            'rowProperties': {'firstBandColor': ALT_ROW_COLOR, 'secondBandColor': WHITE}
+        }}},
+    ]
+
+    # 4. Set Column Widths (Example widths, adjust as needed)
+    widths = {'InstanceId': 150, 'Region': 120, 'InstanceType': 120, 'Name': 200,
+              'Avg.CPU%': 80, 'Avg.CPUCredits': 100, 'Recommendation': 200}
+    for col, header in enumerate(REPORT_HEADERS):
+        requests.append({'updateDimensionProperties': {
+            'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS', 'startIndex': col, 'endIndex': col + 1},
+            'properties': {'pixelSize': widths[header]},
+            'fields': 'pixelSize'
+        }})
+
+    return requests
+
 # --- AWS Functions ---
 
-def get_recommendation(instance_type):
-    # This map controls downsizing.
-    # We will not recommend a size smaller than 'small'.
-    size_map = {
-        '32xlarge': '24xlarge', '24xlarge': '16xlarge',
-        '16xlarge': '12xlarge', '12xlarge': '8xlarge', '8xlarge': '4xlarge',
-        '4xlarge': '2xlarge', '2xlarge': 'xlarge', 'xlarge': 'large',
-        'large': 'medium', 'medium': 'small' 
-    }
+# Struct-of-arrays view of the fleet: parallel lists, one entry per instance
+InstanceSet = collections.namedtuple('InstanceSet', ['ids', 'types', 'names', 'regions'])
+
+def describe_instance_types(region):
+    """Returns ({type: (vCPUs, MiB, bare_metal)}, {family: [(vCPUs, MiB, type, bare_metal), ...] sorted}) for a region, cached for 24h."""
+    cached = _instance_types_cache.get(region)
+    if cached and time.monotonic() - cached[0] < INSTANCE_TYPES_TTL:
+        return cached[1]
+
+    specs = {}
+    families = collections.defaultdict(list)
     try:
-        family, size = instance_type.split('.')
-        recommended = size_map.get(size)
-        
-        if recommended:
-            return f"{family}.{recommended}"
-        
-        # If the size isn't in the map (like 'small', 'micro', 'nano'), 
-        # it will return "Review manually"
+        with _traced('ec2.describe_instance_types', region=region):
+            pages = list(_client('ec2', region).get_paginator('describe_instance_types').paginate())
+        for page in pages:
+            for t in page['InstanceTypes']:
+                spec = (t['VCpuInfo']['DefaultVCpus'], t['MemoryInfo']['SizeInMiB'])
+                bare_metal = t.get('BareMetal', False)
+                specs[t['InstanceType']] = spec + (bare_metal,)
+                families[t['InstanceType'].partition('.')[0]].append(spec + (t['InstanceType'], bare_metal))
+        for family_types in families.values():
+            family_types.sort()
+    except Exception as e:
+        # Cached as empty too, so a missing permission doesn't cost a call per instance
+        logger.warning("Error describing instance types in %s, using the static size map: %s", region, e)
+
+    _instance_types_cache[region] = (time.monotonic(), (specs, families))
+    return specs, families
+
+# This map controls downsizing when the region's type catalog is unavailable.
+# We will not recommend a size smaller than 'small'.
+SIZE_MAP = {
+    '32xlarge': '24xlarge', '24xlarge': '16xlarge',
+    '16xlarge': '12xlarge', '12xlarge': '8xlarge', '8xlarge': '4xlarge',
+    '4xlarge': '2xlarge', '2xlarge': 'xlarge', 'xlarge': 'large',
+    'large': 'medium', 'medium': 'small' 
+}
+BELOW_MIN_SIZES = frozenset({'micro', 'nano'})
+
+def get_recommendation(instance_type, region):
+    family, dot, size = instance_type.partition('.')
+    if not dot:
         return "Review manually"
-        
-    except ValueError:
+
+    specs, families = describe_instance_types(region)
+    if instance_type in specs:
+        # Next-smaller type actually offered in the same family, by (vCPUs, memory)
+        current_vcpus, current_memory, current_metal = specs[instance_type]
+        for vcpus, memory, candidate, bare_metal in reversed(families[family]):
+            # Metal sizes can match an xlarge's specs; only recommend them to instances already on metal
+            if bare_metal and not current_metal:
+                continue
+            if (vcpus, memory) < (current_vcpus, current_memory) and candidate.partition('.')[2] not in BELOW_MIN_SIZES:
+                return candidate
         return "Review manually"
 
+    recommended = SIZE_MAP.get(size)
+    if recommended:
+        return f"{family}.{recommended}"
+
+    # If the size isn't in the map (like 'small', 'micro', 'nano'),
+    # it will return "Review manually"
+    return "Review manually"
+
+def describe_region(region):
+    """Returns parallel (ids, types, names) lists of the reportable running instances in one region, or None on error."""
+    ids, types, names = [], [], []
+    ec2 = _client('ec2', region)
+    try:
+        paginator = ec2.get_paginator('describe_instances')
+        pages = paginator.paginate(
+            Filters=[
+                {'Name': 'instance-state-name', 'Values': ['running']},
+                # Server-side pre-filter; the IGNORE_SIZES check below stays as the safety net
+                {'Name': 'instance-type', 'Values': REPORT_SIZE_PATTERNS}
+            ],
+            PaginationConfig={'PageSize': 1000}     # Max page size, fewest round trips
+        )
+        # Project out only the fields used here instead of walking each full instance description
+        with _traced('ec2.describe_instances', region=region):
+            rows = list(pages.search('Reservations[].Instances[].[InstanceId, InstanceType, Tags]'))
+        for instance_id, instance_type, tags in rows:
+            # Drop ignored sizes up front so they never cost a CloudWatch query
+            _, dot, size = instance_type.partition('.')
+            if not dot or size in IGNORE_SIZES: continue
+            # Tags is None when the instance has none
+            name = next((tag['Value'] for tag in tags or () if tag['Key'] == 'Name'), 'N/A')
+            ids.append(instance_id)
+            types.append(instance_type)
+            names.append(name)
+    except Exception as e:
+        logger.warning("Skipping region %s: %s", region, e)
+        return None
+    return ids, types, names
+
+def get_regions():
+    """Returns the enabled region names, from AWS_REGIONS or a DescribeRegions call cached for 24h."""
+    global _regions_cache
+    if AWS_REGIONS:
+        return AWS_REGIONS
+    fetched_at, regions = _regions_cache
+    if regions is None or time.monotonic() - fetched_at >= REGIONS_TTL:
+        # Region None = the function's own region; errors propagate and nothing is cached
+        with _traced('ec2.describe_regions'):
+            regions = [r['RegionName'] for r in _client('ec2', None).describe_regions()['Regions']]
+        _regions_cache = (time.monotonic(), regions)
+    return regions
+
 def get_running_instances():
-    instances = collections.defaultdict(list)
+    """Returns an InstanceSet of every reportable running instance, grouped contiguously by region."""
+    instances = InstanceSet([], [], [], [])
     try:
-        regions = [r['RegionName'] for r in ec2_client.describe_regions()['Regions']]
+        regions = get_regions()
     except Exception as e:
-        print(f"Error describing regions: {e}")
-        return {}
-        
-    for region in regions:
-        ec2 = boto3.client('ec2', region_name=region)
-        try:
-            reservations = ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])['Reservations']
-            for res in reservations:
-                for inst in res['Instances']:
-                    name = 'N/A'
-                    if 'Tags' in inst:
-                        for tag in inst['Tags']:
-                            if tag['Key'] == 'Name': name = tag['Value']; break
-                    instances[region].append({
-                        'InstanceId': inst['InstanceId'],
-                        'InstanceType': inst['InstanceType'],
-                        'InstanceName': name
-                    })
-        except Exception as e:
-            print(f"Skipping region {region}: {str(e)}")
+        logger.error("Error describing regions: %s", e)
+        return instances
+
+    # Regions are independent and I/O-bound, so query them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DESCRIBE_WORKERS) as executor:
+        described = list(executor.map(describe_region, regions))
+
+    for region, result in zip(regions, described):
+        ids, types, names = result or ([], [], [])
+        instances.ids.extend(ids)
+        instances.types.extend(types)
+        instances.names.extend(names)
+        instances.regions.extend([region] * len(ids))
     return instances
 
-def get_instance_metrics(instance_id, region):
-    cw = boto3.client('cloudwatch', region_name=region)
-    end = datetime.now(timezone.utc)
-    start = end - timedelta(days=REPORTING_PERIOD_DAYS)
-    metrics = {'cpu_avg': 0.0, 'cpu_credit_avg': "N/A"}
+def build_metric_queries(idx, instance_id, instance_type):
+    """Returns the GetMetricData queries for one instance: CPU and its daily coverage, plus credits for the T family."""
     dims = [{'Name': 'InstanceId', 'Value': instance_id}]
-    try:
-        resp = cw.get_metric_data(
-            MetricDataQueries=[
-                {'Id': 'm_cpu', 'MetricStat': {'Metric': {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions': dims}, 'Period': 86400, 'Stat': 'Average'}, 'ReturnData': True},
-                {'Id': 'm_cred', 'MetricStat': {'Metric': {'Namespace': 'AWS/EC2', 'MetricName': 'CPUCreditBalance', 'Dimensions': dims}, 'Period': 86400, 'Stat': 'Average'}, 'ReturnData': True},
-            ],
-            StartTime=start, EndTime=end
-        )
-        for res in resp['MetricDataResults']:
-            if res['Values']:
-                val = sum(res['Values']) / len(res['Values'])
-                if res['Id'] == 'm_cpu': metrics['cpu_avg'] = val
-                elif res['Id'] == 'm_cred': metrics['cpu_credit_avg'] = val
-                
-    # --- ADDED ERROR LOGGING ---
-    except Exception as e:
-        print(f"Error getting metrics for {instance_id} in {region}: {e}")
-        # We will pass, but the error will be in the CloudWatch logs
-        # The function will return the default (0.0 CPU)
-        pass 
-        
-    return metrics
+    queries = [{'Id': f'cpu_{idx}', 'MetricStat': {'Metric': {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions': dims}, 'Period': METRIC_PERIOD, 'Stat': 'Average'}, 'ReturnData': True},
+               # One value per day that has any CPU datapoint; catches instances stopped for most of the window
+               {'Id': f'days_{idx}', 'MetricStat': {'Metric': {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions': dims}, 'Period': COVERAGE_PERIOD, 'Stat': 'SampleCount'}, 'ReturnData': True}]
+    # CPUCreditBalance only exists for burstable (T family) instances
+    if instance_type.partition('.')[0] in BURSTABLE_FAMILIES:
+        queries.append({'Id': f'cred_{idx}', 'MetricStat': {'Metric': {'Namespace': 'AWS/EC2', 'MetricName': 'CPUCreditBalance', 'Dimensions': dims}, 'Period': METRIC_PERIOD, 'Stat': 'Average'}, 'ReturnData': True})
+    return queries
+
+def get_reporting_window():
+    """Returns the (start, end) of the reporting period, aligned to midnight UTC."""
+    # Whole days line up with CloudWatch's daily rollups and give every query in a run the same timespan
+    end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=REPORTING_PERIOD_DAYS)
+    return start, end
 
-def generate_report(instances):
+def fetch_metrics_for_region(region, ids, types, start, end):
+    """Returns parallel (cpu_avgs, credit_avgs, data_days) lists for one region's instances, batching up to 500 queries per call."""
+    # Explicit per-instance MetricStat queries rather than a Metrics Insights
+    # "SELECT AVG(CPUUtilization) ... GROUP BY InstanceId": Insights only looks
+    # back over recent data (hours, not the 30-day window) and caps results at
+    # 500 series, so it can't produce these averages.
+    if not ids:
+        return [], [], []
+    cw = _client('cloudwatch', region)
+    cpu_avgs = [math.nan] * len(ids)        # NaN = no CPU datapoints in the window
+    credit_avgs = [math.nan] * len(ids)     # NaN = no credit data (non-T family or no datapoints)
+    data_days = [0] * len(ids)              # Days of the window with at least one CPU datapoint; None = fetch failed
+
+    # Pack queries into batches of at most 500; non-T instances take two slots, T instances three.
+    # Query Ids carry the instance's position in the slice, so results map straight back.
+    batches = [[]]
+    for idx, (instance_id, instance_type) in enumerate(zip(ids, types)):
+        queries = build_metric_queries(idx, instance_id, instance_type)
+        if len(batches[-1]) + len(queries) > MAX_METRIC_QUERIES:
+            batches.append([])
+        batches[-1].extend(queries)
+
+    def fetch_batch(queries):
+        # Each batch writes to its own indices, so batches can fill the lists concurrently
+        try:
+            # ScanBy ascending so Values[0] is the bucket starting at StartTime, i.e. the full-period average
+            with _traced('cloudwatch.get_metric_data', region=region, queries=len(queries)):
+                pages = list(cw.get_paginator('get_metric_data').paginate(
+                    MetricDataQueries=queries, StartTime=start, EndTime=end, ScanBy='TimestampAscending'
+                ))
+            seen = set()    # A query's later pages only hold later (partial) buckets
+            for page in pages:
+                for res in page['MetricDataResults']:
+                    prefix, idx = res['Id'].split('_')
+                    if prefix == 'days':
+                        # Daily buckets can span pages, so these are counted across all of them
+                        data_days[int(idx)] += len(res['Values'])
+                    elif res['Values'] and res['Id'] not in seen:
+                        seen.add(res['Id'])
+                        val = res['Values'][0]
+                        if prefix == 'cpu': cpu_avgs[int(idx)] = val
+                        elif prefix == 'cred': credit_avgs[int(idx)] = val
+
+        # --- ADDED ERROR LOGGING ---
+        except Exception as e:
+            logger.error("Error getting metrics for a batch of %d queries in %s: %s", len(queries), region, e)
+            # Marked unavailable so the batch's instances are reported as such, never judged on missing data
+            for query in queries:
+                prefix, idx = query['Id'].split('_')
+                if prefix == 'cpu':
+                    cpu_avgs[int(idx)] = credit_avgs[int(idx)] = math.nan
+                    data_days[int(idx)] = None
+
+    if len(batches) == 1:
+        fetch_batch(batches[0])
+    else:
+        # Large regions: issue their batches concurrently rather than one after another
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(batches), BATCH_WORKERS)) as executor:
+            list(executor.map(fetch_batch, batches))
+
+    return cpu_avgs, credit_avgs, data_days
+
+def analyze_region(instances, first, last, start, end):
+    """Fetches metrics for instances[first:last], all in one region, and returns its report rows."""
     data = []
-    for region, inst_list in instances.items():
-        for inst in inst_list:
-            try:
-                family, size = inst['InstanceType'].split('.')
-                if size in IGNORE_SIZES: continue
-            except: continue
-  
-            metrics = get_instance_metrics(inst['InstanceId'], region)
-            rec = "N/A"
-            underutilized = False
-            
-            if inst['InstanceType'].startswith('t') and isinstance(metrics['cpu_credit_avg'], float) and metrics['cpu_credit_avg'] < CPU_CREDIT_THRESHOLD:
-                rec = "Needs Review (Low Credits)"
-            elif metrics['cpu_avg'] < CPU_THRESHOLD:
-                underutilized = True
-                rec = get_recommendation(inst['InstanceType'])
-            
-            if isinstance(metrics['cpu_credit_avg'], float):
-                credits_str = str(int(round(metrics['cpu_credit_avg'], 0)))
-            else:
-                credits_str = metrics['cpu_credit_avg']
-
-            if underutilized or rec != "N/A":
-                data.append({
-                    'InstanceId': inst['InstanceId'], 'Region': region,
-                    'InstanceType': inst['InstanceType'], 'Name': inst['InstanceName'],
-                    'Avg.CPU%': f"{metrics['cpu_avg']:.2f}", 'Avg.CPUCredits': credits_str,
-                    'Recommendation': rec
-                })
+    region = instances.regions[first]
+    ids = instances.ids[first:last]
+    types = instances.types[first:last]
+    names = instances.names[first:last]
+    # One get_recommendation call per distinct type, filled on first use so a region
+    # with nothing to downsize never loads its type catalog
+    recommendations = {}
+
+    cpu_avgs, credit_avgs, data_days = fetch_metrics_for_region(region, ids, types, start, end)
+    # Threshold mask over the metric columns first; only flagged instances need any further work.
+    # Only T instances get a credit value; NaN compares False, so no type check is needed.
+    # No CPU data at all (NaN) is flagged too, for the history note rather than as idle.
+    flagged = [i for i, (cpu_avg, cpu_credit_avg) in enumerate(zip(cpu_avgs, credit_avgs))
+               if math.isnan(cpu_avg) or cpu_credit_avg < CPU_CREDIT_THRESHOLD or cpu_avg < CPU_THRESHOLD]
+    for i in flagged:
+        if data_days[i] is None:
+            rec = "Metrics unavailable (CloudWatch error)"
+        elif data_days[i] < MIN_HISTORY_DAYS:
+            # Averages cover only part of the period: new, or stopped for most of it (new T instances also start low on credits)
+            rec = f"Insufficient history (<{MIN_HISTORY_DAYS} days)"
+        elif credit_avgs[i] < CPU_CREDIT_THRESHOLD:
+            rec = "Needs Review (Low Credits)"
+        else:
+            rec = recommendations.get(types[i])
+            if rec is None:
+                rec = recommendations[types[i]] = get_recommendation(types[i], region)
+
+        # Raw metrics; write_to_sheet formats them (see REPORT_HEADERS)
+        data.append((ids[i], region, types[i], names[i], cpu_avgs[i], credit_avgs[i], rec))
     return data
 
+@contextmanager
+def iter_report(instances):
+    """Starts the per-region analysis and yields an iterator over the report rows; exiting cancels unfinished regions."""
+    # Computed once per run (not at import) so warm Lambda containers don't reuse a stale window
+    start, end = get_reporting_window()
+    # Bounded pool to stay clear of CloudWatch throttling
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=METRICS_WORKERS)
+    # Each region's instances are contiguous, so a region is just a [first, last) slice
+    futures = []
+    first = 0
+    for region, group in groupby(instances.regions):
+        last = first + sum(1 for _ in group)
+        futures.append(executor.submit(analyze_region, instances, first, last, start, end))
+        first = last
+    # Queued regions keep running while the caller authenticates with Google and opens the spreadsheet
+    try:
+        # Rows are yielded region by region as each one completes (in region order)
+        yield (row for future in futures for row in future.result())
+    finally:
+        # After a full read every future is done already. On an error, queued regions are dropped and
+        # in-flight ones are waited for, so Lambda doesn't freeze them mid-call into the next invocation.
+        executor.shutdown(wait=True, cancel_futures=True)
+
 # --- Lambda Handler ---
 def lambda_handler(event, context):
-    print("Starting Rightsizing Analysis (Google Sheets)...")
+    logger.info("Starting Rightsizing Analysis (Google Sheets)...")
     
     instances = get_running_instances()
-    report_data = generate_report(instances)
-    
-    gspread_client = authenticate_gspread()
-    # This will now pass an empty list [] if no instances are found,
-    # or the full report data if they are.
-    write_to_sheet(gspread_client, report_data) 
+    with iter_report(instances) as report_rows:
+        gspread_client = get_gspread_client()
+        # Rows are streamed in as each region finishes; with no underutilized
+        # instances the sheet just gets the "none found" note.
+        count = write_to_sheet(gspread_client, report_rows)
     
-    if report_data:
-        return {"status": "Success", "count": len(report_data)}
\ No newline at end of file
+    if count:
+        return {"status": "Success", "count": count}
\ No newline at end of file
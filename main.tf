@@ -61,7 +61,7 @@ resource "aws_iam_policy" "lambda_policy" {
       {
         Effect = "Allow"
         Action = [
-          "ec2:DescribeRegions", "ec2:DescribeInstances", "ec2:DescribeTags"
+          "ec2:DescribeRegions", "ec2:DescribeInstances", "ec2:DescribeTags", "ec2:DescribeInstanceTypes"
         ]
         Resource = "*"
       },
@@ -75,6 +75,11 @@ resource "aws_iam_policy" "lambda_policy" {
         Action = ["secretsmanager:GetSecretValue"]
         Resource = var.google_secret_arn 
       },
+      {
+        Effect = "Allow"
+        Action = ["xray:PutTraceSegments", "xray:PutTelemetryRecords"]
+        Resource = "*"
+      },
       {
         Effect = "Allow"
         Action = [
@@ -109,6 +114,10 @@ resource "aws_lambda_function" "rightsizing_lambda" {
     }
   }
   
+  tracing_config {
+    mode = "Active"                                 # X-Ray traces; main.py adds subsegments when aws-xray-sdk is in the layer
+  }
+
   layers = [var.gspread_layer_arn] # Attaches the gspread libraries, Lambda inherently does not have access to them
 }
 